@@ -58,7 +58,7 @@ def get_dataset_loader(name, batch_size, num_frames, split='train', hml_mode='tr
 
     return loader
 
-def get_single_input_loader(motion_tensor, text_condition):
+def get_single_input_loader(motion_tensor, text_condition, pin_memory=False):
     from data_loaders.humanml.data.dataset import SingleHumanML3D
     dataset = SingleHumanML3D(motion_tensor, text_condition)
     loader = DataLoader(
@@ -66,6 +66,7 @@ def get_single_input_loader(motion_tensor, text_condition):
         batch_size=1,
         shuffle=False,
         num_workers=0,  # For a single sample, workers aren't necessary.
-        collate_fn=lambda x: t2m_collate(x, 1)
+        collate_fn=lambda x: t2m_collate(x, 1),
+        pin_memory=pin_memory,  # allows non_blocking copies to the GPU
     )
     return loader
\ No newline at end of file
@@ -17,6 +17,7 @@ from diffusion.nn import mean_flat, sum_flat
 from diffusion.losses import normal_kl, discretized_gaussian_log_likelihood
 from data_loaders.humanml.scripts import motion_process
 from utils.loss_util import masked_l2, masked_goal_l2
+from utils.sampler_util import repeat_model_kwargs
 from data_loaders.humanml.scripts.motion_process import get_target_location
 
 def get_named_beta_schedule(schedule_name, num_diffusion_timesteps, scale_betas=1.):
@@ -902,6 +903,10 @@ class GaussianDiffusion:
         if const_noise == True:
             raise NotImplementedError()
 
+        if 'text' in model_kwargs['y'].keys():
+            # encoding once instead of each iteration saves lots of time
+            model_kwargs['y']['text_embed'] = model.encode_text(model_kwargs['y']['text'])
+
         final = None
         for sample in self.ddim_sample_loop_progressive(
             model,
@@ -989,6 +994,111 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def paradigms_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        eta=0.0,
+        skip_timesteps=0,
+        init_image=None,
+        dump_steps=None,
+        const_noise=False,
+        parallel=8,
+        tolerance=0.1,
+    ):
+        """
+        Generate samples using DDIM with ParaDiGMS parallel sampling
+        (https://arxiv.org/abs/2305.16317).
+
+        A sliding window of `parallel` denoising steps is evaluated in a single
+        batched forward pass and refined with Picard iterations; the window
+        slides forward past every step whose update has converged.
+
+        Same usage as ddim_sample_loop(), except that only deterministic
+        sampling (eta=0) is supported.
+
+        :param parallel: the number of denoising steps evaluated together.
+        :param tolerance: the convergence tolerance of a step, relative to the
+                          noise variance at that step.
+        """
+        if dump_steps is not None or const_noise:
+            raise NotImplementedError()
+        if skip_timesteps or init_image is not None:
+            raise NotImplementedError()
+        if eta != 0:
+            raise NotImplementedError('ParaDiGMS sampling only supports deterministic DDIM (eta=0)')
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+
+        if 'text' in model_kwargs['y'].keys():
+            # encoding once instead of each iteration saves lots of time
+            model_kwargs['y']['text_embed'] = model.encode_text(model_kwargs['y']['text'])
+
+        num_steps = self.num_timesteps
+        bs = shape[0]
+        parallel = min(parallel, num_steps)
+        indices = np.arange(num_steps)[::-1].copy()
+
+        # Errors are measured relative to the noise variance of each step; the
+        # final sample is always accepted.
+        inverse_variance_norm = np.append(1. / np.exp(self.posterior_log_variance_clipped[indices]), 0.)
+        inverse_variance_norm = th.from_numpy(inverse_variance_norm / np.prod(shape[1:])).float().to(device)
+        scaled_tolerance = tolerance ** 2
+
+        img = noise if noise is not None else th.randn(*shape, device=device)
+        trajectory = img.unsqueeze(0).repeat(num_steps + 1, *([1] * len(shape)))  # [num_steps+1, bs, ...]
+        block_model_kwargs = {}
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            pbar = tqdm(total=num_steps)
+
+        begin_idx, end_idx = 0, parallel
+        while begin_idx < num_steps:
+            parallel_len = end_idx - begin_idx
+            if parallel_len not in block_model_kwargs:
+                block_model_kwargs[parallel_len] = repeat_model_kwargs(model_kwargs, parallel_len)
+            block_img = trajectory[begin_idx:end_idx].reshape(parallel_len * bs, *shape[1:])
+            t = th.tensor(indices[begin_idx:end_idx], device=device).repeat_interleave(bs)
+            with th.no_grad():
+                out = self.ddim_sample(
+                    model,
+                    block_img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=block_model_kwargs[parallel_len],
+                    eta=0.0,
+                )
+            drift = (out["sample"] - block_img).view(parallel_len, *shape)
+            block_img_new = trajectory[begin_idx][None] + th.cumsum(drift, dim=0)
+
+            error = (block_img_new - trajectory[begin_idx + 1:end_idx + 1]).reshape(parallel_len, bs, -1)
+            error_ratio = error.norm(dim=-1).pow(2) * inverse_variance_norm[begin_idx + 1:end_idx + 1, None]
+            error_ratio = th.cat([error_ratio, error_ratio.new_full((1, bs), 1e9)])  # stop at the window end
+            first_unconverged = th.argmax((error_ratio > scaled_tolerance).any(dim=1).int()).item()
+
+            new_begin_idx = begin_idx + min(1 + first_unconverged, parallel_len)
+            new_end_idx = min(new_begin_idx + parallel, num_steps)
+            trajectory[begin_idx + 1:end_idx + 1] = block_img_new
+            trajectory[end_idx:new_end_idx + 1] = trajectory[end_idx][None]  # init new steps with the last guess
+            if progress:
+                pbar.update(new_begin_idx - begin_idx)
+            begin_idx, end_idx = new_begin_idx, new_end_idx
+
+        if progress:
+            pbar.close()
+        return trajectory[-1]
+
     def plms_sample(
         self,
         model,
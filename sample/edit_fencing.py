@@ -8,11 +8,13 @@ import os
 import numpy as np
 import torch
 import argparse
+from functools import partial
 from utils.parser_util import edit_args
 from sample.generate import save_multiple_samples, construct_template_variables
 from utils.model_util import create_model_and_diffusion, load_saved_model
+from diffusion.respace import space_timesteps
 from utils import dist_util
-from utils.sampler_util import ClassifierFreeSampleModel
+from utils.sampler_util import ClassifierFreeSampleModel, DataParallelSampleModel, repeat_model_kwargs
 from data_loaders.get_data import get_single_input_loader
 from data_loaders.humanml.scripts.motion_process import recover_from_ric
 from data_loaders import humanml_utils
@@ -21,6 +23,17 @@ from data_loaders.humanml.utils.plot_script import plot_3d_motion
 import shutil
 import sys
 
+def recover_xyz(sample, mean, std, n_joints):
+    """
+    Un-normalize HumanML3D vectors and recover the xyz joint positions.
+    :param sample: [bs, njoints, 1, seqlen] normalized hml_vec features.
+    :return: [bs, n_joints, 3, seqlen] positions.
+    """
+    sample = sample.permute(0, 2, 3, 1).float() * std + mean
+    sample = recover_from_ric(sample, n_joints)
+    return sample.permute(0, 1, 3, 4, 2).flatten(0, 1)  # [bs, 1, seqlen, n_joints, 3] -> [bs, n_joints, 3, seqlen]
+
+
 def main():
     extra_parser = argparse.ArgumentParser(add_help=False)
     extra_parser.add_argument('--input_motion_path', type=str,
@@ -29,11 +42,31 @@ def main():
     extra_parser.add_argument('--mask_path', type=str, 
                               default='/home/zhiyin/tml-fencing/mask_mdm.npy',
                               help="Path to a .npy mask file (boolean) matching the input motion length.")
+    extra_parser.add_argument('--sample_precision', default='bf16', choices=['fp32', 'fp16', 'bf16'], type=str,
+                              help="Autocast dtype for the denoiser during sampling (CUDA only). fp32 disables autocast.")
+    extra_parser.add_argument('--timestep_respacing', default='ddim25', type=str,
+                              help="Respace the diffusion timesteps for sampling. 'ddimN' samples with N DDIM steps (eta=0), "
+                                   "an empty string runs the full DDPM trajectory.")
+    extra_parser.add_argument('--parallel_window', default=0, type=int,
+                              help="If larger than 0, sample with ParaDiGMS, denoising this many DDIM steps "
+                                   "in parallel per forward pass.")
+    extra_parser.add_argument('--parallel_tolerance', default=0.1, type=float,
+                              help="Convergence tolerance of the ParaDiGMS Picard iterations.")
+    extra_parser.add_argument('--multi_gpu', action='store_true',
+                              help="Shard the sampling batch across all visible GPUs, gathering the results on --device.")
+    extra_parser.add_argument('--quiet', action='store_true',
+                              help="Don't show the per-step progress bar while sampling.")
     extra_args, remaining_argv = extra_parser.parse_known_args()
     sys.argv = [sys.argv[0]] + remaining_argv
     args = edit_args()
     args.input_motion_path = extra_args.input_motion_path
     args.mask_path = extra_args.mask_path
+    args.sample_precision = extra_args.sample_precision
+    args.timestep_respacing = extra_args.timestep_respacing
+    args.parallel_window = extra_args.parallel_window
+    args.parallel_tolerance = extra_args.parallel_tolerance
+    args.multi_gpu = extra_args.multi_gpu
+    args.quiet = extra_args.quiet
     fixseed(args.seed)
     out_path = args.output_dir
     name = os.path.basename(os.path.dirname(args.model_path))
@@ -60,11 +93,26 @@ def main():
     # (specify through the --seed flag)
     args.batch_size = args.num_samples  # Sampling a single batch from the testset, with exactly args.num_samples
     
-    feat_np = np.load(args.input_motion_path)
+    # memory-map the file and copy it once into a writable, in-memory float32 array
+    feat_np = np.array(np.load(args.input_motion_path, mmap_mode='r'), dtype=np.float32)
     data = get_single_input_loader(motion_tensor=feat_np,
-                                   text_condition=args.text_condition)
+                                   text_condition=args.text_condition,
+                                   pin_memory=dist_util.dev().type == 'cuda')
     total_num_samples = args.num_samples * args.num_repetitions
 
+    # Fetch the (pinned) input batch first, so its H2D copy overlaps with loading the model
+    iterator = iter(data)
+    input_motions, model_kwargs = next(iterator)
+    input_motions = input_motions.to(dist_util.dev(), non_blocking=True)
+
+    if args.timestep_respacing.startswith('ddim'):
+        try:
+            space_timesteps(args.diffusion_steps, args.timestep_respacing)
+        except ValueError:
+            print(f'Cannot respace {args.diffusion_steps} diffusion steps to [{args.timestep_respacing}] '
+                  f'with an integer stride, sampling the full trajectory instead.')
+            args.timestep_respacing = ''
+
     print("Creating model and diffusion...")
     model, diffusion = create_model_and_diffusion(args, data)
 
@@ -74,10 +122,26 @@ def main():
     model = ClassifierFreeSampleModel(model)   # wrapping model with the classifier-free sampler
     model.to(dist_util.dev())
     model.eval()  # disable random masking
+    if args.multi_gpu:
+        ngpu = torch.cuda.device_count() if dist_util.dev().type == 'cuda' else 0
+        if ngpu > 1:
+            # shard the (fat) sampling batch across all visible GPUs, gathering on the main device
+            device_ids = [dist_util.dev().index] + [i for i in range(ngpu) if i != dist_util.dev().index]
+            model = DataParallelSampleModel(model, device_ids)
+            print(f'Sampling on GPUs {device_ids}')
+        else:
+            print('--multi_gpu requires more than one visible GPU, sampling on a single device.')
+
+    # Un-normalize and recover the xyz positions on the sampling device
+    mean = torch.as_tensor(data.dataset.t2m_dataset.mean, dtype=torch.float32, device=dist_util.dev())
+    std = torch.as_tensor(data.dataset.t2m_dataset.std, dtype=torch.float32, device=dist_util.dev())
+
+    # Recover the input motion XYZ *positions* once, on device, and keep them for visualization
+    input_motions_xyz = input_motions
+    if model.data_rep == 'hml_vec':
+        n_joints = 22 if input_motions.shape[1] == 263 else 21
+        input_motions_xyz = recover_xyz(input_motions, mean, std, n_joints).contiguous()
 
-    iterator = iter(data)
-    input_motions, model_kwargs = next(iterator)
-    input_motions = input_motions.to(dist_util.dev())
     texts = [args.text_condition] * args.num_samples
     model_kwargs['y']['text'] = texts
     if args.text_condition == '':
@@ -87,16 +151,17 @@ def main():
     max_frames = input_motions.shape[-1]
     print(f"Input motions with frames: {max_frames}")
 
-    gt_frames_per_sample = {}
+    lengths_np = model_kwargs['y']['lengths'].detach().cpu().numpy()  # the lengths are the same for all repetitions
+    gt_frames_mask = np.zeros((0, max_frames), dtype=bool)  # [n_samples, max_frames], True for gt frames
     model_kwargs['y']['inpainted_motion'] = input_motions
     if args.edit_mode == 'in_between':
+        start_idx, end_idx = (args.prefix_end * lengths_np).astype(int), (args.suffix_start * lengths_np).astype(int)
+        frames = np.arange(max_frames)
+        gt_frames_mask = (frames < start_idx[:, None]) | (frames >= end_idx[:, None])
         model_kwargs['y']['inpainting_mask'] = torch.ones_like(input_motions, dtype=torch.bool,
                                                                device=input_motions.device)  # True means use gt motion
-        for i, length in enumerate(model_kwargs['y']['lengths'].cpu().numpy()):
-            start_idx, end_idx = int(args.prefix_end * length), int(args.suffix_start * length)
-            gt_frames_per_sample[i] = list(range(0, start_idx)) + list(range(end_idx, max_frames))
-            model_kwargs['y']['inpainting_mask'][i, :, :,
-            start_idx: end_idx] = False  # do inpainting in those frames
+        # do inpainting in the frames between each sample's prefix and suffix
+        model_kwargs['y']['inpainting_mask'] &= torch.tensor(gt_frames_mask, device=input_motions.device)[:, None, None, :]
     elif args.edit_mode == 'upper_body':
         model_kwargs['y']['inpainting_mask'] = torch.tensor(humanml_utils.HML_LOWER_BODY_MASK, dtype=torch.bool,
                                                             device=input_motions.device)  # True is lower body data
@@ -105,55 +170,125 @@ def main():
     
     # Load the mask if provided
     if args.mask_path:
-        mask_np = np.load(args.mask_path)
+        mask_np = np.load(args.mask_path, mmap_mode='r')
         assert mask_np.shape == (max_frames,), \
             f"Mask shape {mask_np.shape} != input frames {(max_frames, )}"
-        mask_t = torch.tensor(mask_np, dtype=torch.bool, device=input_motions.device)
-        for i, length in enumerate(model_kwargs['y']['lengths'].cpu().numpy()): # assume same mask for all samples
-            model_kwargs['y']['inpainting_mask'][i, :, :, :] = mask_t
-            gt_frames_per_sample[i] = mask_np.nonzero()[0].tolist()
+        mask_t = torch.from_numpy(mask_np.astype(bool))
+        if input_motions.is_cuda:
+            mask_t = mask_t.pin_memory()
+        mask_t = mask_t.to(input_motions.device, non_blocking=True)
+        model_kwargs['y']['inpainting_mask'][:] = mask_t.view(1, 1, 1, -1)  # assume same mask for all samples
+        gt_frames_mask = np.broadcast_to(mask_np.astype(bool), (args.batch_size, max_frames))
+
+    # Run the denoiser in reduced precision - matmuls are downcast by autocast while the
+    # inpainting mix in p_mean_variance stays in fp32 (inpainted_motion is kept fp32 on purpose).
+    use_autocast = dist_util.dev().type == 'cuda' and args.sample_precision != 'fp32'
+    if use_autocast and args.sample_precision == 'bf16' and \
+            not (hasattr(torch, 'autocast') and torch.cuda.is_bf16_supported()):
+        print('bf16 autocast is not supported by this GPU / torch version, falling back to fp16.')
+        args.sample_precision = 'fp16'
+    autocast_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.sample_precision, torch.float32)
+    if hasattr(torch, 'autocast'):
+        autocast_ctx = partial(torch.autocast, device_type='cuda', dtype=autocast_dtype, enabled=use_autocast)
+    else:  # torch<1.10 only has the fp16 CUDA autocast
+        autocast_ctx = partial(torch.cuda.amp.autocast, enabled=use_autocast)
+    no_grad_ctx = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad  # torch<1.9
 
-    all_motions = []
     all_lengths = []
     all_text = []
 
-    for rep_i in range(args.num_repetitions):
-        print(f'### Start sampling [repetitions #{rep_i}]')
+    # add CFG scale to batch (built once, shared by all repetitions)
+    model_kwargs['y']['scale'] = torch.full((args.batch_size,), args.guidance_param, dtype=torch.float32,
+                                            device=dist_util.dev())
 
-        # add CFG scale to batch
-        model_kwargs['y']['scale'] = torch.ones(args.batch_size, device=dist_util.dev()) * args.guidance_param
+    if isinstance(model, DataParallelSampleModel):
+        # Sanity check of the sharding (the y slicing, the text encoder-less replicas and the gather):
+        # one fp32 denoising step on a batch that spans all GPUs must match the single-device one.
+        check_bs = args.batch_size * max(args.num_repetitions, len(model.device_ids))
+        check_kwargs = repeat_model_kwargs(model_kwargs, check_bs // args.batch_size)
+        with no_grad_ctx():
+            check_kwargs['y']['text_embed'] = model.encode_text(check_kwargs['y']['text'])
+            sharding_error = model.sharding_error(
+                torch.randn((check_bs, model.njoints, model.nfeats, max_frames), device=dist_util.dev()),
+                torch.randint(args.diffusion_steps, (check_bs,), device=dist_util.dev()),
+                check_kwargs['y'])
+        assert sharding_error < 1e-2, f'Sharded sampling diverges from single-GPU sampling (rel. error {sharding_error:.2e})'
+        print(f'Multi-GPU sharding check passed (rel. error {sharding_error:.2e})')
 
+    if args.parallel_window > 0:
+        sample_fn = partial(diffusion.paradigms_sample_loop, eta=0., parallel=args.parallel_window,
+                            tolerance=args.parallel_tolerance)
+    elif args.timestep_respacing.startswith('ddim'):
+        sample_fn = partial(diffusion.ddim_sample_loop, eta=0.)
+    else:
         sample_fn = diffusion.p_sample_loop
 
-        sample = sample_fn(
-            model,
-            (args.batch_size, model.njoints, model.nfeats, max_frames),
-            clip_denoised=False,
-            model_kwargs=model_kwargs,
-            skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
-            init_image=None,
-            progress=True,
-            dump_steps=None,
-            noise=None,
-            const_noise=False,
-        )
+    def run_sample_fn(cur_model_kwargs, batch_size, noise=None):
+        with no_grad_ctx(), autocast_ctx():
+            return sample_fn(
+                model,
+                (batch_size, model.njoints, model.nfeats, max_frames),
+                clip_denoised=False,
+                model_kwargs=cur_model_kwargs,
+                skip_timesteps=0,  # 0 is the default value - i.e. don't skip any step
+                init_image=None,
+                progress=not args.quiet,
+                dump_steps=None,
+                noise=noise,
+                const_noise=False,
+            )
 
+    # Sample all repetitions as one fat batch [num_repetitions * bs, ...] when it fits in memory,
+    # otherwise fall back to sampling them one by one.
+    fat_sample = None
+    if args.num_repetitions > 1:
+        oom = False
+        print(f'### Start sampling [all {args.num_repetitions} repetitions in a single batch]')
+        try:
+            fat_sample = run_sample_fn(repeat_model_kwargs(model_kwargs, args.num_repetitions),
+                                       args.batch_size * args.num_repetitions)
+            fat_sample = fat_sample.view(args.num_repetitions, args.batch_size, *fat_sample.shape[1:])
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            print('Out of memory - sampling the repetitions sequentially instead.')
+            oom = True
+        if oom:
+            # only once the exception (and the frames it references) is gone can its tensors be freed
+            torch.cuda.empty_cache()
+
+    all_motions = None
+    # one device noise buffer, refilled in place for each sequential repetition
+    noise_buf = None
+    if fat_sample is None:
+        noise_buf = torch.empty((args.batch_size, model.njoints, model.nfeats, max_frames), device=dist_util.dev())
+    for rep_i in range(args.num_repetitions):
+        if fat_sample is not None:
+            sample = fat_sample[rep_i]
+        else:
+            print(f'### Start sampling [repetitions #{rep_i}]')
+            sample = run_sample_fn(model_kwargs, args.batch_size, noise=noise_buf.normal_())
 
         # Recover XYZ *positions* from HumanML3D vector representation
         if model.data_rep == 'hml_vec':
             n_joints = 22 if sample.shape[1] == 263 else 21
-            sample = data.dataset.t2m_dataset.inv_transform(sample.cpu().permute(0, 2, 3, 1)).float()
-            sample = recover_from_ric(sample, n_joints)
-            sample = sample.view(-1, *sample.shape[2:]).permute(0, 2, 3, 1)
+            with no_grad_ctx():
+                sample = recover_xyz(sample, mean, std, n_joints)
 
+        # copy asynchronously into a preallocated pinned host buffer, overlapping with the next repetition
+        if all_motions is None:
+            all_motions = torch.empty((args.num_repetitions * args.batch_size, *sample.shape[1:]),
+                                      dtype=sample.dtype, pin_memory=sample.is_cuda)
+        all_motions[rep_i * args.batch_size:(rep_i + 1) * args.batch_size].copy_(sample, non_blocking=True)
         all_text += model_kwargs['y']['text']
-        all_motions.append(sample.cpu().numpy())
-        all_lengths.append(model_kwargs['y']['lengths'].cpu().numpy())
+        all_lengths.append(lengths_np)
 
-        print(f"created {len(all_motions) * args.batch_size} samples")
+        print(f"created {(rep_i + 1) * args.batch_size} samples")
 
 
-    all_motions = np.concatenate(all_motions, axis=0)
+    if all_motions.is_pinned():
+        torch.cuda.synchronize()  # wait for the non-blocking copies
+    all_motions = all_motions.numpy()
     all_motions = all_motions[:total_num_samples]  # [bs, njoints, 6, seqlen]
     all_text = all_text[:total_num_samples]
     all_lengths = np.concatenate(all_lengths, axis=0)[:total_num_samples]
@@ -162,24 +297,26 @@ def main():
         shutil.rmtree(out_path)
     os.makedirs(out_path)
 
-    npy_path = os.path.join(out_path, 'results.npy')
-    print(f"saving results file to [{npy_path}]")
-    np.save(npy_path,
-            {'motion': all_motions, 'text': all_text, 'lengths': all_lengths,
-             'num_samples': args.num_samples, 'num_repetitions': args.num_repetitions})
-    with open(npy_path.replace('.npy', '.txt'), 'w') as fw:
+    # Plain named arrays instead of a pickled dict (no allow_pickle needed on load), motion stored in fp16
+    npz_path = os.path.join(out_path, 'results.npz')
+    print(f"saving results file to [{npz_path}]")
+    np.savez_compressed(npz_path,
+                        motion=all_motions.astype(np.float16), text=np.asarray(all_text), lengths=all_lengths,
+                        num_samples=args.num_samples, num_repetitions=args.num_repetitions)
+    with open(npz_path.replace('.npz', '.txt'), 'w') as fw:
         fw.write('\n'.join(all_text))
-    with open(npy_path.replace('.npy', '_len.txt'), 'w') as fw:
+    with open(npz_path.replace('.npz', '_len.txt'), 'w') as fw:
         fw.write('\n'.join([str(l) for l in all_lengths]))
 
     print(f"saving visualizations to [{out_path}]...")
     skeleton = paramUtil.kit_kinematic_chain if args.dataset == 'kit' else paramUtil.t2m_kinematic_chain
 
-    # Recover XYZ *positions* from HumanML3D vector representation
-    if model.data_rep == 'hml_vec':
-        input_motions = data.dataset.t2m_dataset.inv_transform(input_motions.cpu().permute(0, 2, 3, 1)).float()
-        input_motions = recover_from_ric(input_motions, n_joints)
-        input_motions = input_motions.view(-1, *input_motions.shape[2:]).permute(0, 2, 3, 1).cpu().numpy()
+    input_motions_xyz = input_motions_xyz.cpu().numpy()
+
+    # [num_repetitions, batch_size, ...] views for O(1) (rep_i, sample_i) lookups
+    all_text = np.array(all_text, dtype=object).reshape(args.num_repetitions, args.batch_size)
+    all_lengths = all_lengths.reshape(args.num_repetitions, args.batch_size)
+    all_motions = all_motions.reshape(args.num_repetitions, args.batch_size, *all_motions.shape[1:])
 
 
     sample_print_template, row_print_template, all_print_template, \
@@ -187,46 +324,38 @@ def main():
     max_vis_samples = 6
     num_vis_samples = min(args.num_samples, max_vis_samples)
     animations = np.empty(shape=(args.num_samples, args.num_repetitions), dtype=object)
-    max_length = max(all_lengths)
+    max_length = all_lengths.max()
     
     for sample_i in range(args.num_samples):
         caption = 'Input Motion'
-        length = model_kwargs['y']['lengths'][sample_i]
-        motion = input_motions[sample_i].transpose(2, 0, 1)[:length]
+        length = lengths_np[sample_i]
+        motion = input_motions_xyz[sample_i].transpose(2, 0, 1)[:length]
         save_file = 'input_motion{:02d}.mp4'.format(sample_i)
         animation_save_path = os.path.join(out_path, save_file)
-        rep_files = [animation_save_path]
+        # gt frame indices of this sample, shared by all of its repetitions
+        gt_frames = np.flatnonzero(gt_frames_mask[sample_i]).tolist() if sample_i < len(gt_frames_mask) else []
         # FIXME - fix and bring back the following:
         # print(f'[({sample_i}) "{caption}" | -> {save_file}]')
         # plot_3d_motion(animation_save_path, skeleton, motion, title=caption,
         #                dataset=args.dataset, fps=fps, vis_mode='gt',
-        #                gt_frames=gt_frames_per_sample.get(sample_i, []))
+        #                gt_frames=gt_frames)
         for rep_i in range(args.num_repetitions):
-            caption = all_text[rep_i*args.batch_size + sample_i]
+            caption = all_text[rep_i, sample_i]
             if caption == '':
                 caption = 'Edit [{}] unconditioned'.format(args.edit_mode)
             else:
                 caption = 'Edit [{}]: {}'.format(args.edit_mode, caption)
-            length = all_lengths[rep_i*args.batch_size + sample_i]
-            motion = all_motions[rep_i*args.batch_size + sample_i].transpose(2, 0, 1)[:length]
+            length = all_lengths[rep_i, sample_i]
+            motion = all_motions[rep_i, sample_i].transpose(2, 0, 1)[:length]
             save_file = 'sample{:02d}_rep{:02d}.mp4'.format(sample_i, rep_i)
             animation_save_path = os.path.join(out_path, save_file)
-            rep_files.append(animation_save_path)
-            gt_frames = gt_frames_per_sample.get(sample_i, [])
             print(f'[({sample_i}) "{caption}" | Rep #{rep_i} | -> {save_file}]')
             animations[sample_i, rep_i] = plot_3d_motion(animation_save_path, 
                                                          skeleton, motion, dataset=args.dataset, title=caption, 
                                                          fps=fps, gt_frames=gt_frames, global_coords=False)
             # Credit for visualization: https://github.com/EricGuo5513/text-to-motion
 
-        all_rep_save_file = os.path.join(out_path, 'sample{:02d}.mp4'.format(sample_i))
-        ffmpeg_rep_files = [f' -i {f} ' for f in rep_files]
-        hstack_args = f' -filter_complex hstack=inputs={args.num_repetitions+1}'
-        ffmpeg_rep_cmd = f'ffmpeg -y -loglevel warning ' + ''.join(ffmpeg_rep_files) + f'{hstack_args} {all_rep_save_file}'
-        os.system(ffmpeg_rep_cmd)
-        print(f'[({sample_i}) "{caption}" | all repetitions | -> {all_rep_save_file}]')
-    
-    save_multiple_samples(out_path, {'all': all_file_template}, animations, fps, max(list(all_lengths) + [max_frames]))
+    save_multiple_samples(out_path, {'all': all_file_template}, animations, fps, max(all_lengths.max(), max_frames))
 
     abs_path = os.path.abspath(out_path)
     print(f'[Done] Results are at [{abs_path}]')
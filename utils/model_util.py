@@ -77,7 +77,7 @@ def create_gaussian_diffusion(args):
     predict_xstart = True  # we always predict x_start (a.k.a. x0), that's our deal!
     steps = args.diffusion_steps
     scale_beta = 1.  # no scaling
-    timestep_respacing = ''  # can be used for ddim sampling, we don't use it.
+    timestep_respacing = args.__dict__.get('timestep_respacing', '')  # can be used for ddim sampling (e.g. 'ddim25')
     learn_sigma = False
     rescale_timesteps = False
 
@@ -1,7 +1,9 @@
 import numpy as np
+import threading
 import torch
 import torch.nn as nn
 from copy import deepcopy
+from functools import partial
 from utils.misc import wrapped_getattr
 import joblib
 
@@ -38,6 +40,133 @@ class ClassifierFreeSampleModel(nn.Module):
         return wrapped_getattr(self, name, default=None)
 
 
+# Splits the sampling batch across several GPUs, like torch.nn.DataParallel, but aware of the
+# layout of the conditioning dict (e.g. the cached CLIP text embedding is batched along dim 1)
+class DataParallelSampleModel(nn.Module):
+
+    def __init__(self, model, device_ids):
+        super().__init__()
+        self.model = model  # model should already be on device_ids[0]
+        self.device_ids = device_ids
+
+        # pointers to inner model
+        self.njoints = self.model.njoints
+        self.nfeats = self.model.nfeats
+        self.data_rep = self.model.data_rep
+        self.cond_mode = self.model.cond_mode
+        self.encode_text = self.model.encode_text
+
+        # The model is frozen while sampling, so it is replicated once rather than at every step.
+        # The text encoder is left out of the replicas - the text embedding is cached in y['text_embed'].
+        owners = [m for m in self.model.modules() if 'clip_model' in m._modules]
+        text_encoders = [m._modules.pop('clip_model') for m in owners]
+        try:
+            self.replicas = nn.parallel.replicate(self.model, [torch.device('cuda', d) for d in device_ids], detach=True)
+        finally:
+            for m, clip_model in zip(owners, text_encoders):
+                m._modules['clip_model'] = clip_model
+
+    def forward(self, x, timesteps, y=None):
+        bs = x.shape[0]
+        devices = [torch.device('cuda', d) for d in self.device_ids[:min(len(self.device_ids), bs)]]
+        bounds = np.linspace(0, bs, len(devices) + 1).astype(int)
+        replicas = self.replicas[:len(devices)]
+        inputs, kwargs = [], []
+        for device, start, end in zip(devices, bounds[:-1], bounds[1:]):
+            inputs.append((x[start:end].to(device), timesteps[start:end].to(device)))
+            kwargs.append({'y': self._slice_y(y, start, end, bs, device)})
+        outputs = self._parallel_apply(replicas, inputs, kwargs, devices)
+        return nn.parallel.gather(outputs, devices[0])
+
+    def sharding_error(self, x, timesteps, y=None):
+        """
+        Relative max abs difference between a sharded forward pass and the same pass of the wrapped
+        model on device_ids[0]. A sanity check of the sharding, to be run without autocast.
+        """
+        out = self.model(x, timesteps, y)
+        return ((self(x, timesteps, y) - out).abs().max() / out.abs().max().clamp(min=1e-8)).item()
+
+    @staticmethod
+    def _parallel_apply(replicas, inputs, kwargs, devices):
+        # Like nn.parallel.parallel_apply, but the worker threads also take the caller's autocast dtype
+        # and inference / no-grad mode, which are thread-local (parallel_apply only forwards whether
+        # autocast is enabled, so bf16 silently became fp16).
+        autocast_enabled = torch.is_autocast_enabled()
+        if hasattr(torch, 'get_autocast_gpu_dtype'):
+            autocast_ctx = partial(torch.autocast, device_type='cuda', dtype=torch.get_autocast_gpu_dtype(),
+                                   enabled=autocast_enabled)
+        else:  # torch<1.10 only has the fp16 CUDA autocast
+            autocast_ctx = partial(torch.cuda.amp.autocast, enabled=autocast_enabled)
+        if hasattr(torch, 'is_inference_mode_enabled') and torch.is_inference_mode_enabled():
+            grad_ctx = partial(torch.inference_mode, True)
+        else:
+            grad_ctx = partial(torch.set_grad_enabled, torch.is_grad_enabled())
+
+        results = [None] * len(replicas)
+
+        def _worker(i):
+            try:
+                with torch.cuda.device(devices[i]), grad_ctx(), autocast_ctx():
+                    results[i] = replicas[i](*inputs[i], **kwargs[i])
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=_worker, args=(i,)) for i in range(len(replicas))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for out in results:
+            if isinstance(out, Exception):
+                raise out
+        return results
+
+    @staticmethod
+    def _slice_y(y, start, end, bs, device):
+        y_chunk = {}
+        for key, val in y.items():
+            if key == 'text_embed':
+                if isinstance(val, tuple):  # BERT: ([seq_len, bs, d], [bs, seq_len])
+                    enc_text, text_mask = val
+                    if enc_text.shape[1] == bs:
+                        enc_text = enc_text[:, start:end]
+                    if text_mask.shape[0] == bs:
+                        text_mask = text_mask[start:end]
+                    val = (enc_text.to(device), text_mask.to(device))
+                else:  # CLIP: [1, bs, d]
+                    val = (val[:, start:end] if val.shape[1] == bs else val).to(device)
+            elif torch.is_tensor(val):
+                val = (val[start:end] if val.dim() > 0 and val.shape[0] == bs else val).to(device)
+            elif isinstance(val, list) and len(val) == bs:
+                val = val[start:end]
+            y_chunk[key] = val
+        return y_chunk
+
+    def __getattr__(self, name, default=None):
+        # this method is reached only if name is not in self.__dict__.
+        return wrapped_getattr(self, name, default=None)
+
+
+def repeat_model_kwargs(model_kwargs, n):
+    """
+    Repeat the batch of the conditioning in model_kwargs['y'] n times, in the
+    same block order as x.repeat(n, ...).
+    """
+    y = {}
+    for key, val in model_kwargs['y'].items():
+        if key == 'text_embed':
+            if isinstance(val, tuple):  # BERT: ([seq_len, bs, d], [bs, seq_len])
+                val = (val[0].repeat(1, n, 1), val[1].repeat(n, 1))
+            else:  # CLIP: [1, bs, d]
+                val = val.repeat(1, n, 1)
+        elif torch.is_tensor(val) and val.dim() > 0:
+            val = val.repeat(n, *([1] * (val.dim() - 1)))
+        elif isinstance(val, list):
+            val = val * n
+        y[key] = val
+    return {**model_kwargs, 'y': y}
+
+
 class AutoRegressiveSampler():
     def __init__(self, args, sample_fn, required_frames=196):
         self.sample_fn = sample_fn
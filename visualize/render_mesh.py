@@ -15,6 +15,8 @@ if __name__ == '__main__':
     parsed_name = os.path.basename(params.input_path).replace('.mp4', '').replace('sample', '').replace('rep', '')
     sample_i, rep_i = [int(e) for e in parsed_name.split('_')]
     npy_path = os.path.join(os.path.dirname(params.input_path), 'results.npy')
+    if not os.path.exists(npy_path):
+        npy_path = npy_path.replace('.npy', '.npz')  # results of sample/edit_fencing.py
     out_npy_path = params.input_path.replace('.mp4', '_smpl_params.npy')
     assert os.path.exists(npy_path)
     results_dir = params.input_path.replace('.mp4', '_obj')
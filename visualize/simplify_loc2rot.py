@@ -43,8 +43,16 @@ class joints2smpl:
 
 
     def npy2smpl(self, npy_path):
-        out_path = npy_path.replace('.npy', '_rot.npy')
-        motions = np.load(npy_path, allow_pickle=True)[None][0]
+        out_path = os.path.splitext(npy_path)[0] + '_rot.npy'
+        motions = np.load(npy_path, allow_pickle=True)
+        if npy_path.endswith('.npz') and 'arr_0' not in motions.files:
+            # named arrays (e.g. from sample/edit_fencing.py), motion is stored in fp16
+            motions = {k: motions[k] for k in motions.files}
+            motions['motion'] = motions['motion'].astype(np.float32)
+        else:
+            if npy_path.endswith('.npz'):
+                motions = motions['arr_0']
+            motions = motions[None][0]
         # print_batch('', motions)
         n_samples = motions['motion'].shape[0]
         all_thetas = []
@@ -123,9 +131,9 @@ if __name__ == '__main__':
 
     simplify = joints2smpl(device_id=params.device, cuda=params.cuda)
 
-    if os.path.isfile(params.input_path) and params.input_path.endswith('.npy'):
+    if os.path.isfile(params.input_path) and params.input_path.endswith(('.npy', '.npz')):
         simplify.npy2smpl(params.input_path)
     elif os.path.isdir(params.input_path):
-        files = [os.path.join(params.input_path, f) for f in os.listdir(params.input_path) if f.endswith('.npy')]
+        files = [os.path.join(params.input_path, f) for f in os.listdir(params.input_path) if f.endswith(('.npy', '.npz'))]
         for f in files:
             simplify.npy2smpl(f)
\ No newline at end of file
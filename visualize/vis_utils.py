@@ -9,9 +9,14 @@ class npy2obj:
     def __init__(self, npy_path, sample_idx, rep_idx, device=0, cuda=True):
         self.npy_path = npy_path
         self.motions = np.load(self.npy_path, allow_pickle=True)
-        if self.npy_path.endswith('.npz'):
-            self.motions = self.motions['arr_0']
-        self.motions = self.motions[None][0]
+        if self.npy_path.endswith('.npz') and 'arr_0' not in self.motions.files:
+            # named arrays (e.g. from sample/edit_fencing.py), motion is stored in fp16
+            self.motions = {k: self.motions[k] for k in self.motions.files}
+            self.motions['motion'] = self.motions['motion'].astype(np.float32)
+        else:
+            if self.npy_path.endswith('.npz'):
+                self.motions = self.motions['arr_0']
+            self.motions = self.motions[None][0]
         self.rot2xyz = Rotation2xyz(device='cpu')
         self.faces = self.rot2xyz.smpl_model.faces
         self.bs, self.njoints, self.nfeats, self.nframes = self.motions['motion'].shape